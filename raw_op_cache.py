@@ -0,0 +1,277 @@
+"""
+Keeps a local copy of the raw .op.gz files downloaded from NOAA so the
+cleaning can be re-run without downloading the archive again.
+
+Files are stored as cache_dir/<year>/<station file>/<NOAA modified>.op.gz,
+so a new version on NOAA's server is a new cache entry. A file counts as
+used when it is downloaded, requested again by an update, or read by a
+reprocessing run; each use sets its mtime, which is what the LRU eviction
+sorts on.
+
+Each year also gets a manifest.csv listing the files NOAA had for that
+year. Reprocessing only reads the files in the manifest and uses it to
+tell whether the cache is complete.
+"""
+
+import os
+import shutil
+import tempfile
+import pandas as pd
+from clean_and_export_op_file import robust_download
+from clean_and_export_op_file import raw_op_to_clean_dataframe
+
+
+default_cache_max_bytes = 20*1024**3
+# evict down to this fraction of the limit so we don't rescan on every file
+eviction_target_fraction = 0.9
+
+
+def raw_op_cache_path(cache_dir, year, station_file, modified):
+    return os.path.join(cache_dir, str(year), station_file,
+                        modified.strftime('%Y%m%d%H%M%S')+'.op.gz')
+
+
+def list_cached_files(cache_dir):
+    """
+    Return (mtime, size, path) for every cached raw file.
+    """
+    cached_files = []
+    for dir_path, dir_names, file_names in os.walk(cache_dir):
+        for fname in file_names:
+            if not fname.endswith('.op.gz'):
+                continue
+            path = os.path.join(dir_path, fname)
+            stats = os.stat(path)
+            cached_files.append((stats.st_mtime, stats.st_size, path))
+    return cached_files
+
+
+def raw_op_cache_size(cache_dir):
+    if not os.path.exists(cache_dir):
+        return 0
+    return sum(size for mtime, size, path in list_cached_files(cache_dir))
+
+
+def fetch_raw_op(station_url, year, station_file, modified, cache_dir):
+    """
+    Return the path to a local copy of station_url, downloading it only
+    if this version isn't cached yet, and the number of bytes the cache
+    grew by. Older versions of the same station year are removed once
+    the new one is saved.
+    """
+    path = raw_op_cache_path(cache_dir, year, station_file, modified)
+    if os.path.exists(path):
+        os.utime(path, None)
+        return path, 0
+    station_dir = os.path.dirname(path)
+    if not os.path.exists(station_dir):
+        os.makedirs(station_dir)
+    data = robust_download(station_url).read()
+    # write to a unique temp file so a partial write is never cached
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=station_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    bytes_added = len(data)
+    for fname in os.listdir(station_dir):
+        old_path = os.path.join(station_dir, fname)
+        if fname.endswith('.op.gz') and old_path != path:
+            bytes_added -= os.path.getsize(old_path)
+            os.remove(old_path)
+    return path, bytes_added
+
+
+def evict_raw_op_cache(cache_dir, max_bytes=default_cache_max_bytes,
+                       keep_paths=()):
+    """
+    If the cache is over max_bytes, delete the least recently used files
+    until it is back under eviction_target_fraction of the limit.
+    Files in keep_paths are in use and are never evicted.
+    Returns the size of the cache afterwards.
+    """
+    cached_files = list_cached_files(cache_dir)
+    total_bytes = sum(size for mtime, size, path in cached_files)
+    if total_bytes <= max_bytes:
+        return total_bytes
+    target_bytes = max_bytes*eviction_target_fraction
+    for mtime, size, path in sorted(cached_files):
+        if total_bytes <= target_bytes:
+            break
+        if path in keep_paths:
+            continue
+        os.remove(path)
+        total_bytes -= size
+        if not os.listdir(os.path.dirname(path)):
+            os.rmdir(os.path.dirname(path))
+    return total_bytes
+
+
+def fetch_raw_op_within_limit(station_url, year, station_file, modified,
+                              cache_dir, cache_bytes, max_bytes):
+    """
+    Fetch a file into the cache, evicting other files if that takes the
+    cache over max_bytes. cache_bytes is the running size of the cache.
+    Returns the path to the file and the new size of the cache.
+    """
+    path, bytes_added = fetch_raw_op(
+        station_url, year, station_file, modified, cache_dir)
+    cache_bytes += bytes_added
+    if cache_bytes > max_bytes:
+        cache_bytes = evict_raw_op_cache(cache_dir, max_bytes, [path])
+    return path, cache_bytes
+
+
+def save_raw_op_manifest(NOAA_files, year, cache_dir):
+    """
+    Record which files NOAA has for a year and when they were modified,
+    and drop any cached station files NOAA no longer has.
+    """
+    year_dir = os.path.join(cache_dir, str(year))
+    if not os.path.exists(year_dir):
+        os.makedirs(year_dir)
+    NOAA_files[['File', 'Modified']].to_csv(
+        os.path.join(year_dir, 'manifest.csv'), index=False)
+    for station_file in os.listdir(year_dir):
+        station_dir = os.path.join(year_dir, station_file)
+        if (os.path.isdir(station_dir) and
+                station_file not in NOAA_files['File'].values):
+            shutil.rmtree(station_dir)
+
+
+def load_raw_op_manifest(year, cache_dir):
+    path = os.path.join(cache_dir, str(year), 'manifest.csv')
+    if not os.path.exists(path):
+        return None
+    return pd.read_csv(path, dtype={'File': str}, parse_dates=['Modified'])
+
+
+def cached_years(cache_dir):
+    return sorted(yr for yr in os.listdir(cache_dir)
+                  if os.path.isdir(os.path.join(cache_dir, yr)))
+
+
+def cached_raw_op_paths(cache_dir, year):
+    """
+    Return a dict of station file to the path of its most recent
+    cached version for a year.
+    """
+    year_dir = os.path.join(cache_dir, str(year))
+    paths = {}
+    for station_file in sorted(os.listdir(year_dir)):
+        station_dir = os.path.join(year_dir, station_file)
+        if not os.path.isdir(station_dir):
+            continue
+        versions = [fname for fname in os.listdir(station_dir)
+                    if fname.endswith('.op.gz')]
+        if versions:
+            paths[station_file] = os.path.join(station_dir, max(versions))
+    return paths
+
+
+def find_missing_raw_ops(year, cache_dir):
+    """
+    Return the station files in a year's manifest that are not cached,
+    or whose cached copy is older than NOAA's, or None if there is no
+    manifest to check against.
+    """
+    manifest = load_raw_op_manifest(year, cache_dir)
+    if manifest is None:
+        return None
+    paths = cached_raw_op_paths(cache_dir, year)
+    missing = []
+    for station_file, modified in manifest[['File', 'Modified']].values:
+        expected_path = raw_op_cache_path(
+            cache_dir, year, station_file, pd.to_datetime(modified))
+        # timestamped file names sort in modification order
+        if paths.get(station_file, '') < expected_path:
+            missing.append(station_file)
+    return missing
+
+
+def fill_raw_op_cache(NOAA_files, year, year_url, cache_dir,
+                      max_bytes=default_cache_max_bytes):
+    """
+    Download every file NOAA has for a year that isn't cached yet, so the
+    year can be reprocessed even if its outputs are already up to date.
+    Returns the number of files downloaded.
+    """
+    save_raw_op_manifest(NOAA_files, year, cache_dir)
+    missing = find_missing_raw_ops(year, cache_dir)
+    NOAA_files = NOAA_files[NOAA_files['File'].isin(missing)]
+    cache_bytes = raw_op_cache_size(cache_dir)
+    for station_file, modified in NOAA_files[['File', 'Modified']].values:
+        path, cache_bytes = fetch_raw_op_within_limit(
+            year_url+station_file, year, station_file, modified, cache_dir,
+            cache_bytes, max_bytes)
+    return len(NOAA_files)
+
+
+def save_cached_isd_history(metadata, cache_dir):
+    """
+    Keep a copy of the station metadata alongside the raw files so that
+    reprocessing doesn't need to fetch it from NOAA.
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    metadata.to_parquet(os.path.join(cache_dir, 'isd-history.parquet'),
+                        engine='pyarrow')
+
+
+def load_cached_isd_history(cache_dir):
+    return pd.read_parquet(os.path.join(cache_dir, 'isd-history.parquet'),
+                           engine='pyarrow')
+
+
+def reprocess_year_from_cache(year, metadata, cache_dir):
+    """
+    Yield a cleaned dataframe for each station file cached for a year,
+    limited to the files in the year's manifest if there is one.
+    Reading a file counts as a use for the LRU eviction.
+    """
+    paths = cached_raw_op_paths(cache_dir, year)
+    manifest = load_raw_op_manifest(year, cache_dir)
+    for station_file, path in sorted(paths.items()):
+        if manifest is not None and station_file not in manifest.File.values:
+            continue
+        os.utime(path, None)
+        yield raw_op_to_clean_dataframe(path, metadata)
+
+
+def reprocess_GSOD_from_cache(cache_dir, output_dir, years=None,
+                              metadata=None, allow_missing=False):
+    """
+    Re-run the cleaning over every cached raw file and write the results
+    to output_dir/<year>/<ID>.csv. Makes no network requests.
+
+    Each year is checked against its manifest first. Unless allow_missing
+    is set, a year with evicted, stale or never cached files raises an
+    exception rather than producing a partial dataset.
+    """
+    if metadata is None:
+        metadata = load_cached_isd_history(cache_dir)
+    if years is None:
+        years = cached_years(cache_dir)
+    for year in years:
+        missing = find_missing_raw_ops(year, cache_dir)
+        if missing is None:
+            print("No manifest for "+str(year)+", can't check completeness")
+        elif missing:
+            message = (str(len(missing))+" files missing from the cache for "
+                       + str(year)+": "+', '.join(missing[:10]))
+            if not allow_missing:
+                raise Exception(message)
+            print(message)
+        year_dir = os.path.join(output_dir, str(year))
+        if not os.path.exists(year_dir):
+            os.makedirs(year_dir)
+        file_counter = 0
+        for df in reprocess_year_from_cache(year, metadata, cache_dir):
+            df.to_csv(os.path.join(year_dir, df.ID.iloc[0]+'.csv'),
+                      index=False)
+            file_counter += 1
+        print("Reprocessed "+str(file_counter)+" files in "+str(year))
@@ -15,17 +15,39 @@ from clean_and_export_op_file import raw_op_to_clean_dataframe
 from clean_and_export_op_file import load_isd_history
 from clean_and_export_op_file import robust_get_from_NOAA_ftp
 from clean_and_export_op_file import get_station_year_inventory
+from raw_op_cache import default_cache_max_bytes
+from raw_op_cache import fetch_raw_op_within_limit
+from raw_op_cache import fill_raw_op_cache
+from raw_op_cache import raw_op_cache_size
+from raw_op_cache import save_raw_op_manifest
+from raw_op_cache import save_cached_isd_history
 
 
 root_gsod_url = 'http://www1.ncdc.noaa.gov/pub/data/gsod/'
+inventory_index_key = 'isd-inventory/index.csv'
+inventory_stations_key = 'isd-inventory/stations.csv'
+month_cols = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN',
+              'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
+inventory_cols = ['ID', 'USAF', 'WBAN', 'YEAR', 'Last_Updated'] + month_cols
 
 
 def organize_inventory_cols(inventory):
     # ensure columns are organized properly
-    cols = ['ID', 'USAF', 'WBAN', 'YEAR', 'Last_Updated', 'JAN', 'FEB',
-            'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG',
-            'SEP', 'OCT', 'NOV', 'DEC']
-    return inventory[cols]
+    return inventory[inventory_cols]
+
+
+def set_inventory_dtypes(inventory):
+    """
+    Force the inventory columns to their expected types, so that shards
+    round trip the same way whether they are empty or not.
+    """
+    inventory = organize_inventory_cols(inventory).copy()
+    for col in ['ID', 'USAF', 'WBAN', 'YEAR']:
+        inventory[col] = inventory[col].astype(str)
+    inventory['Last_Updated'] = pd.to_datetime(inventory['Last_Updated'])
+    inventory[month_cols] = inventory[month_cols].astype(int)
+    inventory.index.name = 'Station-Year'
+    return inventory
 
 
 def get_yrs_data_available():
@@ -46,17 +68,29 @@ def get_yrs_data_available():
     return df
 
 
-def load_isd_inventory(bucket_name):
+def is_missing_key_error(error):
     """
-    Load the isd_inventory into a dataframe if it already exists.
+    True if a ClientError means the S3 object doesn't exist, rather than
+    a permissions problem or a transient failure.
+    """
+    return error.response['Error']['Code'] in ['NoSuchKey', '404']
+
+
+def load_legacy_isd_inventory(bucket_name):
+    """
+    Load the monolithic isd-inventory.csv from S3 if it exists.
     If it doesn't exist, download it from NOAA.
+
+    Only used to seed the sharded inventory the first time it is built.
     """
     s3 = boto3.resource('s3')
     try:
         inventory = StringIO(s3.Object(bucket_name, 'isd-inventory.csv')
                              .get()['Body'].read())
         is_from_NOAA = False
-    except botocore.exceptions.ClientError:
+    except botocore.exceptions.ClientError as e:
+        if not is_missing_key_error(e):
+            raise
         # Get the current isd-inventory from NOAA's ftp server
         inventory = robust_get_from_NOAA_ftp(
             '/pub/data/noaa/', 'isd-inventory.csv')
@@ -78,6 +112,161 @@ def load_isd_inventory(bucket_name):
     return inventory
 
 
+def inventory_shard_key(year):
+    return 'isd-inventory/'+str(year)+'.parquet'
+
+
+def empty_inventory_shard():
+    """
+    Return a correctly typed inventory with no rows, for years that
+    have not been inventoried yet.
+    """
+    return set_inventory_dtypes(pd.DataFrame(columns=inventory_cols))
+
+
+def save_inventory_shard(shard, year, inventory_index, bucket_name):
+    """
+    Write one year of the inventory to S3 as parquet and record it in
+    the index. Returns the updated index.
+    """
+    shard = set_inventory_dtypes(shard)
+    key = inventory_shard_key(year)
+    df_to_parquet_on_s3(shard, bucket_name, key)
+    inventory_index.loc[str(year)] = [key, len(shard), pd.datetime.today()]
+    return inventory_index
+
+
+def save_inventory_index(inventory_index, bucket_name):
+    df_to_csv_on_s3(inventory_index, bucket_name, inventory_index_key, True)
+
+
+def build_inventory_shards(bucket_name):
+    """
+    Split the legacy monolithic inventory into one shard per year and
+    write the index. Only needs to happen once per bucket.
+    """
+    print("Building sharded inventory from isd-inventory.csv")
+    inventory = load_legacy_isd_inventory(bucket_name)
+    inventory_index = pd.DataFrame(columns=['Key', 'Rows', 'Last_Updated'])
+    inventory_index.index.name = 'Year'
+    for year, shard in inventory.groupby('YEAR'):
+        inventory_index = save_inventory_shard(
+            shard, year, inventory_index, bucket_name)
+    save_inventory_stations(count_station_years(inventory), bucket_name)
+    save_inventory_index(inventory_index, bucket_name)
+    return inventory_index
+
+
+def load_inventory_index(bucket_name):
+    """
+    Load the index of inventory shards, building the shards from the
+    legacy inventory if no index exists yet.
+    """
+    s3 = boto3.resource('s3')
+    try:
+        inventory_index = StringIO(s3.Object(bucket_name, inventory_index_key)
+                                   .get()['Body'].read())
+    except botocore.exceptions.ClientError as e:
+        # only rebuild when the index is really missing, as it overwrites
+        # every shard with the legacy inventory
+        if not is_missing_key_error(e):
+            raise
+        return build_inventory_shards(bucket_name)
+    return pd.read_csv(inventory_index, index_col='Year',
+                       dtype={'Year': str, 'Key': str},
+                       parse_dates=['Last_Updated'])
+
+
+def load_inventory_shard(year, inventory_index, bucket_name):
+    """
+    Load the inventory for a single year.
+    """
+    if str(year) not in inventory_index.index:
+        return empty_inventory_shard()
+    s3 = boto3.resource('s3')
+    key = inventory_index.Key.loc[str(year)]
+    shard = pd.read_parquet(
+        StringIO(s3.Object(bucket_name, key).get()['Body'].read()),
+        engine='pyarrow')
+    return set_inventory_dtypes(shard)
+
+
+def count_station_years(inventory):
+    """
+    Return each station's ID, USAF and WBAN along with the number of
+    years it appears in the inventory.
+    """
+    station_years = inventory.drop_duplicates(subset=['ID', 'YEAR'])
+    stations = station_years.drop_duplicates(subset='ID').set_index('ID')
+    stations = stations[['USAF', 'WBAN']]
+    stations['Year_Count'] = station_years.groupby('ID').size()
+    return stations
+
+
+def update_inventory_stations(stations, old_shard, new_shard):
+    """
+    Apply one year's change to the station list, dropping stations that
+    no longer appear in any year.
+    """
+    old_counts = count_station_years(old_shard)
+    new_counts = count_station_years(new_shard)
+    new_stations = new_counts[~new_counts.index.isin(stations.index)].copy()
+    new_stations['Year_Count'] = 0
+    stations = pd.concat([stations, new_stations])
+    stations['Year_Count'] += (
+        new_counts['Year_Count'].reindex(stations.index, fill_value=0) -
+        old_counts['Year_Count'].reindex(stations.index, fill_value=0))
+    return stations[stations['Year_Count'] > 0]
+
+
+def save_inventory_stations(stations, bucket_name):
+    df_to_csv_on_s3(stations, bucket_name, inventory_stations_key, True)
+
+
+def load_inventory_stations(bucket_name, inventory_index):
+    """
+    Load the list of every station in the inventory, so the metadata can
+    be updated without reading the shards. Rebuilds it from the shards
+    if it doesn't exist yet.
+    """
+    s3 = boto3.resource('s3')
+    try:
+        stations = StringIO(s3.Object(bucket_name, inventory_stations_key)
+                            .get()['Body'].read())
+    except botocore.exceptions.ClientError as e:
+        if not is_missing_key_error(e):
+            raise
+        stations = count_station_years(load_isd_inventory(
+            bucket_name, ['ID', 'USAF', 'WBAN', 'YEAR'], inventory_index))
+        save_inventory_stations(stations, bucket_name)
+        return stations
+    return pd.read_csv(stations, index_col='ID',
+                       dtype={col: str for col in ['ID', 'USAF', 'WBAN']})
+
+
+def iter_inventory_shards(bucket_name, inventory_index=None):
+    """
+    Yield (year, shard) pairs, loading each shard only when it is reached.
+    """
+    if inventory_index is None:
+        inventory_index = load_inventory_index(bucket_name)
+    for year in inventory_index.index.values:
+        yield year, load_inventory_shard(year, inventory_index, bucket_name)
+
+
+def load_isd_inventory(bucket_name, columns=None, inventory_index=None):
+    """
+    Load the full inventory by merging all of the yearly shards.
+    Pass columns to keep only a subset of each shard while merging.
+    """
+    shards = [shard if columns is None else shard[columns] for year, shard
+              in iter_inventory_shards(bucket_name, inventory_index)]
+    if not shards:
+        inventory = empty_inventory_shard()
+        return inventory if columns is None else inventory[columns]
+    return pd.concat(shards)
+
+
 def df_to_csv_on_s3(df, bucket_name, key, csv_copy_index):
     s3 = boto3.resource('s3')
     f_buffer = StringIO()
@@ -86,6 +275,14 @@ def df_to_csv_on_s3(df, bucket_name, key, csv_copy_index):
     s3.Object(bucket_name, key).put(Body=f_buffer)
 
 
+def df_to_parquet_on_s3(df, bucket_name, key):
+    s3 = boto3.resource('s3')
+    f_buffer = StringIO()
+    df.to_parquet(f_buffer, engine='pyarrow')
+    f_buffer.seek(0)
+    s3.Object(bucket_name, key).put(Body=f_buffer)
+
+
 def get_years_to_check(bucket_name):
     """
     Return a list of all years for which the NOAA server has more
@@ -120,8 +317,10 @@ def identify_files_on_NOAA_server_for_year(year):
     return NOAA_files
 
 
-def get_stations_to_update_for_year(year, inventory, bucket):
-    NOAA_files = identify_files_on_NOAA_server_for_year(year)
+def get_stations_to_update_for_year(year, inventory, bucket,
+                                    NOAA_files=None):
+    if NOAA_files is None:
+        NOAA_files = identify_files_on_NOAA_server_for_year(year)
     s3 = boto3.resource('s3')
     files_on_s3 = [obj.key for obj in bucket.objects.filter(
         Prefix=str(year)+'/')]
@@ -135,23 +334,37 @@ def get_stations_to_update_for_year(year, inventory, bucket):
                           inventory.ID.isin(NOAA_files.ID)]
     files_to_update = NOAA_files.merge(inventory[inventory.YEAR == str(year)],
                                        how='left', on='ID')
+    # stations missing from the inventory have never been downloaded
+    files_to_update['Last_Updated'] = files_to_update['Last_Updated'].fillna(
+        pd.to_datetime(0))
     files_to_update = files_to_update[
         files_to_update['Modified'] > files_to_update['Last_Updated']]
     return inventory, files_to_update
 
 
-def update_year(year, inventory, bucket, metadata):
+def update_year(year, inventory, bucket, metadata, cache_dir=None,
+                cache_max_bytes=default_cache_max_bytes):
     """
     Downloads any files that have more recent versions on NOAA's server
     than on S3, updates the inventory accordingly.
+
+    If cache_dir is set the raw files are kept there for reprocessing.
     """
     print "Now updating "+str(year)
+    NOAA_files = identify_files_on_NOAA_server_for_year(year)
     inventory, files_to_update = get_stations_to_update_for_year(
-        year, inventory, bucket)
+        year, inventory, bucket, NOAA_files)
+    if cache_dir is not None:
+        save_raw_op_manifest(NOAA_files, year, cache_dir)
+        cache_bytes = raw_op_cache_size(cache_dir)
     year_url = root_gsod_url+str(year)+'/'
     download_counter = 0
-    for station in files_to_update['File'].values:
+    for station, modified in files_to_update[['File', 'Modified']].values:
         station_url = year_url+station
+        if cache_dir is not None:
+            station_url, cache_bytes = fetch_raw_op_within_limit(
+                station_url, year, station, modified, cache_dir,
+                cache_bytes, cache_max_bytes)
         df = raw_op_to_clean_dataframe(station_url, metadata)
         df_inventory = get_station_year_inventory(df)
         inventory = inventory[inventory.index.values != df_inventory.index[0]]
@@ -177,35 +390,68 @@ def update_metadata(metadata, inventory):
     return pd.concat([extra_stns, metadata], ignore_index=True)
 
 
-def update_GSOD(bucket_name):
-    inventory = load_isd_inventory(bucket_name)
+def update_GSOD(bucket_name, cache_dir=None,
+                cache_max_bytes=default_cache_max_bytes):
+    inventory_index = load_inventory_index(bucket_name)
     years_to_check, annual_logs = get_years_to_check(bucket_name)
     print('Preparing to update the following years:\n'+str(years_to_check))
     s3 = boto3.resource('s3')
     bucket = s3.Bucket(bucket_name)
     metadata = load_isd_history()
+    if cache_dir is not None:
+        save_cached_isd_history(metadata, cache_dir)
+    if not years_to_check:
+        return
+    stations = load_inventory_stations(bucket_name, inventory_index)
     for year in years_to_check:
-        inventory = update_year(year, inventory, bucket, metadata)
-        inventory = organize_inventory_cols(inventory)
-        df_to_csv_on_s3(inventory, bucket_name, 'isd-inventory.csv', True)
+        old_inventory = load_inventory_shard(
+            year, inventory_index, bucket_name)
+        inventory = update_year(year, old_inventory, bucket, metadata,
+                                cache_dir, cache_max_bytes)
+        inventory_index = save_inventory_shard(
+            inventory, year, inventory_index, bucket_name)
+        stations = update_inventory_stations(
+            stations, old_inventory, inventory)
+        save_inventory_stations(stations, bucket_name)
+        save_inventory_index(inventory_index, bucket_name)
         annual_logs.Modified.loc[year] = pd.datetime.today()
         df_to_csv_on_s3(
             annual_logs, bucket_name, 'annual_update_log.csv', True)
         print("Logs updated for "+str(year))
-    metadata = update_metadata(metadata, inventory)
+    metadata = update_metadata(metadata, stations.reset_index())
     df_to_csv_on_s3(metadata, bucket_name, 'isd-history.csv', True)
 
 
-def run_GSOD_update_daily(bucket_name):
+def fill_GSOD_cache(cache_dir, years=None,
+                    cache_max_bytes=default_cache_max_bytes):
+    """
+    Download every raw file NOAA has for the given years (all years by
+    default) that isn't cached yet. update_GSOD only caches the files it
+    updates, so this is how the cache gets seeded for reprocessing.
+    """
+    save_cached_isd_history(load_isd_history(), cache_dir)
+    if years is None:
+        years = get_yrs_data_available().index.values
+    for year in years:
+        NOAA_files = identify_files_on_NOAA_server_for_year(year)
+        year_url = root_gsod_url+str(year)+'/'
+        download_count = fill_raw_op_cache(
+            NOAA_files, year, year_url, cache_dir, cache_max_bytes)
+        print("Cached "+str(download_count)+" files for "+str(year))
+
+
+def run_GSOD_update_daily(bucket_name, cache_dir=None,
+                          cache_max_bytes=default_cache_max_bytes):
     """
     Repeat the update once per day, indefinitely.
     """
     seconds_per_day = 60*60*24
     while True:
-        update_GSOD(bucket_name)
+        update_GSOD(bucket_name, cache_dir, cache_max_bytes)
         print "GSOD updated "+str(pd.datetime.today())
         sleep(seconds_per_day)
 
 
 if __name__ == '__main__':
-    update_GSOD(sys.argv[1])
+    # optional second argument is a local directory to cache raw files in
+    update_GSOD(*sys.argv[1:3])